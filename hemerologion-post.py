@@ -35,13 +35,18 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 """
 import argparse
+import base64
 import csv
 from datetime import datetime, timezone
+import functools
+import json
 from mastodon import Mastodon
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import sys
 import time
+from urllib3.util import Retry
 #from atproto import Client, client_utils
 
 
@@ -53,12 +58,91 @@ BLUESKY_BASE = "https://bsky.social/xrpc"
 MASTODON_BASE = "https://mas.to"
 UA = "hemerologion-post"
 
+# Settings required for each platform, when posting to it is enabled
+REQUIRED_CONFIG = {
+    "BLUESKY": ("BLUESKY_ID", "BLUESKY_PASSWORD"),
+    "MASTODON": ("MASTODON_KEY", "MASTODON_SECRET", "MASTODON_TOKEN"),
+}
 
-def load_posts(fn):
-    """Load existing posts from TSV file"""
+
+def env_flag(name):
+    """Return whether environment variable name is set to a true value"""
+    return os.environ.get(name, "0") not in ("", "0")
+
+
+def load_config():
+    """Read settings from the environment"""
+    return {
+        "BLUESKY": env_flag("BLUESKY"),
+        "BLUESKY_ID": os.environ.get("BLUESKY_ID"),
+        "BLUESKY_PASSWORD": os.environ.get("BLUESKY_PASSWORD"),
+        "MASTODON": env_flag("MASTODON"),
+        "MASTODON_KEY": os.environ.get("MASTODON_KEY"),
+        "MASTODON_SECRET": os.environ.get("MASTODON_SECRET"),
+        "MASTODON_TOKEN": os.environ.get("MASTODON_TOKEN"),
+    }
+
+
+def check_config(cfg, platform):
+    """Raise an error if platform is enabled but missing required settings"""
+    missing = [k for k in REQUIRED_CONFIG[platform] if not cfg[k]]
+
+    if cfg[platform] and missing:
+        raise HemerologionPostError(
+            f"{platform} is enabled but {', '.join(missing)} not set"
+        )
+
+
+CFG = load_config()
+
+# Whether posting is enabled, decided once per run
+DO_BLUESKY = CFG["BLUESKY"]
+DO_MASTODON = CFG["MASTODON"]
+
+# One session for the whole run so the connection to the Bluesky PDS is kept
+# alive between requests
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": UA})
+
+# Retry only when the request cannot have been processed: connection
+# failures before anything was sent, and 429/503 responses. A read error or
+# dropped connection after the body was sent is not retried, since the post
+# may already have gone through
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=8,
+        max_retries=Retry(
+            total=3,
+            connect=3,
+            read=0,
+            other=0,
+            backoff_factor=0.5,
+            status_forcelist=[429, 503],
+            allowed_methods=["POST"],
+        ),
+    ),
+)
+
+
+def iter_posts_for_day(fn, date):
+    """Yield posts from TSV file matching the given date"""
     with open(fn) as posts:
         reader = csv.reader(posts, delimiter="\t", quoting=csv.QUOTE_NONNUMERIC)
-        return tuple([tuple(r) for r in reader])
+        found = False
+
+        # Posts are in date order, so stop reading after the last match
+        for r in reader:
+            if r[1] == date:
+                found = True
+
+                # Unescape newlines once here, rather than wherever the text
+                # is used
+                r[3] = r[3].replace("\\n", "\n")
+                yield r
+            elif found:
+                return
 
 
 def post_date(d=None):
@@ -69,11 +153,6 @@ def post_date(d=None):
     return datetime.now().strftime("%Y-%b-%d")
 
 
-def posts_for_day(date, posts):
-    """Return only posts matching the given date"""
-    return tuple([p for p in posts if p[1] == date])
-
-
 def get_visibility(private):
     """Return requested visibility for Mastodon."""
     if private:
@@ -82,41 +161,22 @@ def get_visibility(private):
     return "public"
 
 
-def do_bluesky(opts):
-    """Check whether Bluesky posting is enabled"""
-    # if opts.test:
-    #     return opts.bluesky and os.environ.get("BLUESKY", False)
-
-    return int(os.environ.get("BLUESKY", 0))
+def jwt_expiry(jwt):
+    """Return the expiry time (the "exp" claim) of a JWT"""
+    payload = jwt.split(".")[1]
+    claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    return claims["exp"]
 
 
-def do_mastodon(opts):
-    """Check whether Mastodon posting is enabled"""
-    # if opts.test:
-    #     return opts.mastodon and os.environ.get("MASTODON", False)
-
-    return int(os.environ.get("MASTODON", 0))
-
-
-def post_to_bluesky(post):
-    """Post to Bluesky"""
-
-    # client = Client()
-    # profile = client.login(os.environ["BLUESKY_ID"], os.environ["BLUESKY_PASSWORD"])
-    # #print('Welcome,', profile.display_name)
-
-    
-    # text = client_utils.TextBuilder().text(post[3]) #.link('Python SDK', 'https://atproto.blue')
-
-    #print(text)
-    #bsky_post = client.send_post(text)
-
+@functools.lru_cache(maxsize=1)
+def bluesky_session():
+    """Authenticate to Bluesky. Return (jwt, did, expiry)"""
     try:
-        resp = requests.post(
+        resp = SESSION.post(
             BLUESKY_BASE + "/com.atproto.server.createSession",
             json={
-                "identifier": os.environ["BLUESKY_ID"],
-                "password": os.environ["BLUESKY_PASSWORD"],
+                "identifier": CFG["BLUESKY_ID"],
+                "password": CFG["BLUESKY_PASSWORD"],
             },
         )
 
@@ -125,28 +185,77 @@ def post_to_bluesky(post):
         resp_data = resp.json()
         jwt = resp_data["accessJwt"]
         did = resp_data["did"]
+        expiry = jwt_expiry(jwt)
 
-    except requests.exceptions.HTTPError as e:
+    # Includes the RetryError raised once the 429/503 retries run out, and
+    # connection errors, not just HTTPError from raise_for_status()
+    except requests.exceptions.RequestException as e:
         raise HemerologionPostError(f"Failed to authenticate to Bluesky {e}")
 
-    iso_timestamp = datetime.now(timezone.utc).isoformat()
-    iso_timestamp = iso_timestamp[:-6] + "Z"
+    # A response without the expected fields, or a token that isn't a JWT with
+    # an "exp" claim (binascii.Error and json.JSONDecodeError are ValueErrors)
+    except (IndexError, KeyError, ValueError) as e:
+        raise HemerologionPostError(f"Unexpected Bluesky session {e!r}")
+
+    return (jwt, did, expiry)
 
+
+def bluesky_auth():
+    """Return (jwt, did), authenticating only if there is no fresh session"""
+    (jwt, did, expiry) = bluesky_session()
+
+    if expiry - time.time() < 60:
+        bluesky_session.cache_clear()
+        (jwt, did, expiry) = bluesky_session()
+
+    return (jwt, did)
+
+
+def iso_timestamp():
+    """Return the current UTC time in the format Bluesky expects"""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def post_to_bluesky(posts, jwt, did):
+    """Post to Bluesky, all posts in a single applyWrites request
+
+    applyWrites is atomic: if any one record is rejected, none of the day's
+    posts are made (where posting them one by one would have made the rest).
+    """
+
+    # client = Client()
+    # profile = client.login(os.environ["BLUESKY_ID"], os.environ["BLUESKY_PASSWORD"])
+    # #print('Welcome,', profile.display_name)
+
+    
+    # text = client_utils.TextBuilder().text(post[3]) #.link('Python SDK', 'https://atproto.blue')
+
+    #print(text)
+    #bsky_post = client.send_post(text)
+
+    # The writes are applied in order, so multi-part posts (like the year
+    # summary) appear in sequence
     post_data = {
         "repo": did,
-        "collection": "app.bsky.feed.post",
-        "record": {
-            "$type": "app.bsky.feed.post",
-            "text": post,
-            "createdAt": iso_timestamp,
-        },
+        "writes": [
+            {
+                "$type": "com.atproto.repo.applyWrites#create",
+                "collection": "app.bsky.feed.post",
+                "value": {
+                    "$type": "app.bsky.feed.post",
+                    "text": post,
+                    "createdAt": iso_timestamp(),
+                },
+            }
+            for post in posts
+        ],
     }
 
-    headers = {"Authorization": "Bearer " + jwt, "User-Agent": UA}
+    headers = {"Authorization": "Bearer " + jwt}
 
     try:
-        resp = requests.post(
-            BLUESKY_BASE + "/com.atproto.repo.createRecord",
+        resp = SESSION.post(
+            BLUESKY_BASE + "/com.atproto.repo.applyWrites",
             json=post_data,
             headers=headers,
         )
@@ -154,47 +263,54 @@ def post_to_bluesky(post):
         print(resp)
         resp.raise_for_status()
 
-    except requests.exceptions.HTTPError as e:
+    # Includes the RetryError raised once the 429/503 retries run out, and
+    # connection errors, not just HTTPError from raise_for_status()
+    except requests.exceptions.RequestException as e:
         raise HemerologionPostError("Failed to post to Bluesky ({})".format(e))
 
-    return "posted to Bluesky"
+    return f"posted {len(posts)} to Bluesky"
 
 
-def post_to_mastodon(post, vis="public"):
-    """Post to Mastodon"""
-    mastodon = Mastodon(
-        client_id=os.environ["MASTODON_KEY"],
-        client_secret=os.environ["MASTODON_SECRET"],
-        access_token=os.environ["MASTODON_TOKEN"],
+@functools.lru_cache(maxsize=1)
+def mastodon_client():
+    """Return Mastodon client, created once and reused for every post"""
+    return Mastodon(
+        client_id=CFG["MASTODON_KEY"],
+        client_secret=CFG["MASTODON_SECRET"],
+        access_token=CFG["MASTODON_TOKEN"],
         api_base_url=MASTODON_BASE,
         user_agent=UA,
     )
 
-    mastodon.status_post(post, visibility=vis, language="en")
+
+def post_to_mastodon(post, vis="public"):
+    """Post to Mastodon"""
+    mastodon_client().status_post(post, visibility=vis, language="en")
 
     return "Posted to Mastodon"
 
 
-def show_posts(p, args):
-    print("-" * 60)
-    print(f"#{int(p[0])} {p[1]} ({int(p[2])} characters)")
-    print("=" * 35)
-    print(p[3].replace("\\n", "\n"))
-    print("-" * 60)
+def show_posts(posts, args):
+    for p in posts:
+        print("-" * 60)
+        print(f"#{int(p[0])} {p[1]} ({int(p[2])} characters)")
+        print("=" * 35)
+        print(p[3])
+        print("-" * 60)
 
 
-def post_bluesky(post, args):
-    if not do_bluesky(args):
+def post_bluesky(posts, args):
+    if not DO_BLUESKY or not posts:
         return
 
-    return post_to_bluesky(post[3].replace("\\n", "\n"))
-    
+    return post_to_bluesky([post[3] for post in posts], *bluesky_auth())
+
 
-def post_mastodon(post, args):
-    if not do_mastodon(args):
+def post_mastodon(posts, args):
+    if not DO_MASTODON:
         return
 
-    return post_to_mastodon(post[3].replace("\\n", "\n"))
+    return tuple([post_to_mastodon(post[3]) for post in posts])
 
 
 if __name__ == "__main__":
@@ -242,8 +358,15 @@ variable, respectively, set to true values (i.e., MASTODON=1).
 
     args = parser.parse_args()
 
-    posts = posts_for_day(args.for_date, load_posts(args.tsv))
+    # Only the platform being posted to needs its settings
+    if args.command == "post" and args.platform:
+        check_config(CFG, args.platform.upper())
 
-    for p in posts:
-        args.func(p, args)
+    # Don't bother reading posts if there is nowhere to post them
+    if args.command == "post" and not (DO_BLUESKY or DO_MASTODON):
+        sys.exit()
+
+    posts = tuple(iter_posts_for_day(args.tsv, args.for_date))
+
+    args.func(posts, args)
 
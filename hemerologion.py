@@ -37,58 +37,151 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 """
 import argparse
+from collections import namedtuple
 import csv
 from datetime import datetime
+import functools
+import heapq
 import heniautos as ha
 import juliandate as jd
-import re
-from itertools import groupby
+import os
+import pickle
+from itertools import islice
 import sys
 
 AMPH = "\U0001F3FA"  # Amphora emoji
+CSV_BATCH = 256  # Number of rows to write at once
+
+# Bump whenever the parsed rows change shape or types, so that pickled TSV
+# caches written by older code are ignored
+TSV_CACHE_VERSION = 2
+
+# A row of festivals.tsv
+FestRow = namedtuple(
+    "FestRow", ("month", "day", "post", "link", "name", "description", "span")
+)
+
+
+def parse_field(field):
+    """Convert TSV field: quoted is a string, unquoted is a number"""
+    if field.startswith('"'):
+        # Like csv, keep any stray text after the closing quote
+        end = field.rfind('"')
+        return field[1:end].replace('""', '"') + field[end + 1 :]
+
+    if not field:
+        return field
+
+    try:
+        return int(field)
+    except ValueError:
+        return float(field)
+
+
+def read_tsv(fn):
+    """Read rows from TSV file, parsing it again only if it has changed"""
+    return read_tsv_version(fn, os.path.getmtime(fn))
+
+
+@functools.lru_cache(maxsize=4)
+def read_tsv_version(fn, mtime):
+    """Read rows from TSV file as of mtime, via a pickled copy if up to date"""
+    cache = fn + ".pkl"
+
+    try:
+        with open(cache, "rb") as cached:
+            (version, cached_mtime, rows) = pickle.load(cached)
+
+        if version == TSV_CACHE_VERSION and cached_mtime == mtime:
+            return rows
+    except (OSError, EOFError, TypeError, ValueError, pickle.UnpicklingError):
+        pass
+
+    # The data files have no tabs or newlines inside fields, so plain
+    # splitting is enough and much cheaper than the csv module
+    with open(fn, "r") as tsv:
+        rows = tuple(
+            [
+                tuple([parse_field(f) for f in line.rstrip("\r\n").split("\t")])
+                for line in tsv
+                if line.strip()
+            ]
+        )
+
+    # The cache is only an optimization, so don't fail if it can't be written
+    try:
+        with open(cache + ".tmp", "wb") as cached:
+            pickle.dump((TSV_CACHE_VERSION, mtime, rows), cached)
+
+        os.replace(cache + ".tmp", cache)
+    except OSError:
+        pass
+
+    return rows
 
 
 def load_day_names():
     """Load Greek day names from TSV file"""
-    with open("day_names.tsv", "r") as names:
-        reader = csv.reader(names, delimiter="\t", quoting=csv.QUOTE_NONNUMERIC)
-
-        # Make a dict. The day numbers are the keys, Greek names the values
-        return dict([r[0:2] for r in reader])
+    # Make a dict. The day numbers are the keys, Greek names the values
+    return dict([r[0:2] for r in read_tsv("day_names.tsv")])
 
 
 def load_festivals():
-    """Load festivals from TSV file"""
-    with open("festivals.tsv", "r") as fests:
-        reader = csv.reader(fests, delimiter="\t", quoting=csv.QUOTE_NONNUMERIC)
+    """Load festivals from TSV file, sorted by month and day"""
+    # The sort is stable, so festivals on the same day keep their TSV order
+    rows = sorted(read_tsv("festivals.tsv"), key=lambda r: (r[0], r[1]))
+    return tuple([FestRow(*r) for r in rows])
 
-        return tuple([tuple(r) for r in reader])
 
-        # Make a dict. The day numbers are the keys, Greek names the values
-        return dict([((r[0], r[1], r[4]), tuple(r[2:])) for r in reader])
+def index_festivals(fests, key):
+    """Group festivals into a dict of tuples by key(festival)"""
+    index = {}
+    for f in fests:
+        index.setdefault(key(f), []).append(f)
+
+    return {k: tuple(v) for k, v in index.items()}
 
 
 GK_DAY = load_day_names()
 
 FEST = load_festivals()
 
+# Festivals by month and by (month, day) so lookups don't scan all of FEST
+FEST_BY_MONTH = index_festivals(FEST, lambda f: f.month)
+FEST_BY_MONTH_DAY = index_festivals(FEST, lambda f: (f.month, f.day))
+
 
 def get_current_posts(fn):
     """Load existing posts from TSV file"""
     with open(fn, "r") as posts:
         reader = csv.reader(posts, delimiter="\t", quoting=csv.QUOTE_NONNUMERIC)
 
-        return tuple([r for r in reader])
+        return list(reader)
+
+
+def today_jdn(d=None):
+    """Return today's Julian Date (or that of datetime d)."""
+    if d is None:
+        d = datetime.today()
+
+    return int(
+        jd.from_gregorian(
+            d.year, d.month, d.day, d.hour, d.minute, d.second, d.microsecond
+        )
+        + 0.5
+    )
 
 
-def today_jdn():
-    """Return today's Julian Date."""
-    return int(jd.from_gregorian(*datetime.today().timetuple()[0:7]) + 0.5)
+@functools.lru_cache(None)
+def arkhon_year(year):
+    """Return the archon year (e.g. 2024/2025) for an astronomical year (cached)"""
+    return ha.arkhon_year(year).split()[-1]
 
 
-def today_year():
-    """Return the current day's year"""
-    return datetime.today().year
+@functools.lru_cache(None)
+def greek_month_name(month):
+    """Return the Greek name of a month (cached)"""
+    return ha.month_name(month, name_as=ha.MonthNameOptions.GREEK)
 
 
 def gregorian_date(day):
@@ -96,33 +189,57 @@ def gregorian_date(day):
     return ha.as_gregorian(day.jdn).split()[-1]
 
 
-def get_count_of_days(count, year, from_jdn):
-    """Return a list of days of length 'count' after day 'from_jdn'"""
+@functools.lru_cache(maxsize=8)
+def festival_calendar(year):
+    """Return the Athenian festival calendar for a year (cached)"""
+    return ha.athenian_festival_calendar(year)
 
-    cal = tuple(
-        [d for d in ha.athenian_festival_calendar(year) if d.jdn > from_jdn][0:count]
-    )
-    if len(cal) < count:
-        return cal + get_count_of_days(count - len(cal), year + 1, from_jdn)
 
-    return tuple(cal)
+@functools.lru_cache(maxsize=8)
+def calendar_months(year):
+    """Return the festival calendar for a year, split into months (cached)"""
+    return ha.by_months(festival_calendar(year))
+
+
+def days_after(year, from_jdn):
+    """Yield every day after day 'from_jdn', from calendar 'year' onward"""
+    while True:
+        for d in festival_calendar(year):
+            if d.jdn > from_jdn:
+                yield d
+
+        year += 1
+
+
+def get_count_of_days(count, year, from_jdn):
+    """Return a list of days of length 'count' after day 'from_jdn'"""
+    return tuple(islice(days_after(year, from_jdn), count))
 
 
-def get_calendar(options):
-    """Return tuple of days matching options"""
+def get_calendar(options, today=None):
+    """Return tuple of days matching options (counting -d from datetime today)"""
     if options.year:
-        return ha.athenian_festival_calendar(options.year)
+        return festival_calendar(options.year)
 
     if options.days:
-        return get_count_of_days(options.days, today_year() - 1, today_jdn())
+        if today is None:
+            today = datetime.today()
 
-    raise KeyError("No Valid Option")
+        jdn = today_jdn(today)
+        year = today.year
+
+        # Until Hekatombaiṓn 1, today is still in the previous year's
+        # calendar. The new year always starts in June or July, so only then
+        # does the current year's calendar need to be built to find out
+        if today.month < 6:
+            year -= 1
+        elif today.month < 8 and festival_calendar(year)[0].jdn > jdn:
+            year -= 1
+
+        return get_count_of_days(options.days, year, jdn)
 
+    raise KeyError("No Valid Option")
 
-def despan(name, span):
-    """Turn a list of date into a single x–y span"""
-    dates = [int(d[0]) for d in span]
-    return (min(dates), f"{min(dates)}–{max(dates)}: {name[0]} ({name[1]})")
 
 def festival_name(name, greek):
     """Format the name of a festival, with or without Greek version"""
@@ -132,110 +249,126 @@ def festival_name(name, greek):
     return name
 
 
-def single_day_festivals(day):
-    """Format summaries of single-day festivals"""
-    return tuple(
-        [
-            (d[1], f"{int(d[1])}: {festival_name(d[4], d[5])}")
-            for d in FEST
-            if d[0] == day.month and d[-1] == 1
-        ]
-    )
+def month_festivals(month):
+    """Format summaries of single-day and multiple-day festivals in a month"""
+    single = []
 
+    # Collect the days of each festival. groupby would only group rows that
+    # happen to be next to each other in the TSV
+    spans = {}
 
-def multiple_day_festivals(day):
-    """Format summaries of festivals spanning multiple days"""
-    spans = groupby(
-        [(d[1], d[4], d[5]) for d in FEST if d[0] == day.month and d[-1] > 1],
-        key=lambda x: x[1:],
-    )
-    return tuple([despan(*s) for s in spans])
+    for d in FEST_BY_MONTH.get(month, ()):
+        if d.span == 1:
+            single.append(
+                (d.day, f"{int(d.day)}: {festival_name(d.name, d.description)}")
+            )
+        elif d.span > 1:
+            spans.setdefault((d.name, d.description), []).append(int(d.day))
 
+    multiple = [
+        (min(days), f"{min(days)}–{max(days)}: {name} ({greek})")
+        for (name, greek), days in spans.items()
+    ]
 
-def festival_summary(day):
-    """Summarize festivals occuring in this month"""
+    return (tuple(single), tuple(multiple))
 
-    if day.day != 1:
-        return ()
 
-    festivals = sorted(
-        single_day_festivals(day) + multiple_day_festivals(day), key=lambda x: x[0]
-    )
+@functools.lru_cache(maxsize=32)
+def summarize_festivals(month, month_name):
+    """Format summary of festivals in a month (cached)"""
+    # FEST is sorted by day, so both lists already are and just need merging.
+    # On ties, merge takes from the single-day festivals first
+    festivals = tuple(heapq.merge(*month_festivals(month), key=lambda x: x[0]))
 
     if len(festivals):
         return (
-            f"Festivals in {day.month_name}:\n\n"
-            + "\n".join([f[1] for f in festivals]),
+            f"Festivals in {month_name}:\n\n" + "\n".join([f[1] for f in festivals]),
         )
 
     return ()
 
 
-def month_summary(day):
-    """Format summary of month"""
+def festival_summary(day):
+    """Summarize festivals occuring in this month"""
+
     if day.day != 1:
         return ()
 
-    if day.month_length == 29:
+    return summarize_festivals(day.month, day.month_name)
+
+
+@functools.lru_cache(maxsize=32)
+def summarize_month(month_name, month_length):
+    """Format summary of a month's length (cached)"""
+    if month_length == 29:
         return (
-            f"This {day.month_name} will have 29 days, which the ancient "
+            f"This {month_name} will have 29 days, which the ancient "
             "Greeks called a “hollow month” (κοῖλος μήν) as opposed to a "
             "“full month” (πλήρης μήν) of 30.",
         )
 
     return (
-        f"This {day.month_name} will have 30 days, which the ancient Greeks "
+        f"This {month_name} will have 30 days, which the ancient Greeks "
         "called a “full month” (πλήρης μήν) as opposed to a “hollow month” "
         "(κοῖλος μήν) of 29.",
     )
 
 
+def month_summary(day):
+    """Format summary of month"""
+    if day.day != 1:
+        return ()
+
+    return summarize_month(day.month_name, day.month_length)
+
+
+@functools.lru_cache(maxsize=64)
+def julian_date(jdn):
+    """Return Julian date of a JDN as YYYY-Mon-DD (cached)"""
+    return ha.as_julian(jdn).split()[-1]
+
+
+def julian_month_day(jdn):
+    """Return Julian date of a JDN as Mon DD"""
+    # YYYY-Mon-DD always ends with Mon-DD
+    return julian_date(jdn)[-6:].replace("-", " ")
+
+
 def summary_of_months(months, second_half=False):
-    summary = ""
+    """Format start and end dates of the first (or last) six months"""
+    summary = []
     for month in months[6:] if second_half else months[0:6]:
-        start = " ".join(ha.as_julian(month[0]).split()[-1].split("-")[1:3])
-        end = " ".join(ha.as_julian(month[-1]).split()[-1].split("-")[1:3])
-        summary += f"{month[0].month_name}: {start}–{end}\n"
+        start = julian_month_day(month[0].jdn)
+        end = julian_month_day(month[-1].jdn)
+        summary.append(f"{month[0].month_name}: {start}–{end}\n")
 
-    return summary
+    return "".join(summary)
 
 
 def summarize_first_half(months):
     """Format summary of the first six months of the year."""
 
     day1 = months[0][0]
-    year = ha.arkhon_year(day1.astronomical_year).split()[-1]
+    year = arkhon_year(day1.astronomical_year)
     year_type = "ordinary" if day1.year_length < 380 else "intercalary"
     month_count = 12 if day1.year_length < 380 else 13
 
     if month_count != 12:
         raise ValueError("This does not yet handle intercalary years!!")
 
-    summary1 = (
+    return (
         f"{year} will be an {year_type} year of {day1.year_length} "
-        f"days, ending on {ha.as_julian(months[-1][-1]).split()[-1]}. As an "
+        f"days, ending on {julian_date(months[-1][-1].jdn)}. As an "
         f"{year_type} year there will be {month_count} months (1/2):\n\n"
+        + summary_of_months(months)
     )
 
-    for month in months[0:6]:
-        start = " ".join(ha.as_julian(month[0]).split()[-1].split("-")[1:3])
-        end = " ".join(ha.as_julian(month[-1]).split()[-1].split("-")[1:3])
-        summary1 += f"{month[0].month_name}: {start}–{end}\n"
-
-    return summary1
-
 
 def summarize_second_half(months):
     """Format summary of last six months of the year."""
-    year = ha.arkhon_year(months[0][0].astronomical_year).split()[-1]
-
-    summary2 = f"Months in {year} (2/2):\n\n"
-    for month in months[6:]:
-        start = " ".join(ha.as_julian(month[0]).split()[-1].split("-")[1:3])
-        end = " ".join(ha.as_julian(month[-1]).split()[-1].split("-")[1:3])
-        summary2 += f"{month[0].month_name}: {start}–{end}\n"
+    year = arkhon_year(months[0][0].astronomical_year)
 
-    return summary2
+    return f"Months in {year} (2/2):\n\n" + summary_of_months(months, True)
 
 
 def year_summary(day):
@@ -244,7 +377,7 @@ def year_summary(day):
     if day.doy != 1:
         return ()
 
-    months = ha.by_months(ha.athenian_festival_calendar(day.astronomical_year))
+    months = calendar_months(day.astronomical_year)
 
     # This has to be split into two posts because it is long
     return (summarize_first_half(months), summarize_second_half(months))
@@ -270,7 +403,7 @@ def festivals_by_day(day):
     """Return festivals for a given day"""
     # Festivals on the last day are recorded as day -1
     day_day = backwards_count(day)
-    return [f for f in FEST if f[0] == day.month and f[1] == day_day]
+    return FEST_BY_MONTH_DAY.get((day.month, day_day), ())
 
 
 def festivals(day):
@@ -280,8 +413,8 @@ def festivals(day):
     if not in_month:
         return ()
 
-    post = f"{AMPH} " + "\n".join([f[2] for f in in_month])
-    links = [f[3] for f in in_month if f[3] is not None]
+    post = f"{AMPH} " + "\n".join([f.post for f in in_month])
+    links = [f.link for f in in_month if f.link is not None]
 
     if links:
         return (post + "\n\n" + "\n".join(links),)
@@ -291,7 +424,7 @@ def festivals(day):
 
 def doy_count(day):
     """Format DOY part of post"""
-    year = ha.arkhon_year(day.astronomical_year).split()[-1]
+    year = arkhon_year(day.astronomical_year)
 
     if day.doy == 1:
         return f"day {day.doy} of {day.year_length}. Happy New Year {year}! {AMPH}{AMPH}{AMPH}"
@@ -302,25 +435,38 @@ def doy_count(day):
     return f"day {day.doy} of {day.year_length} in the year {year}."
 
 
+@functools.lru_cache(None)
 def to_genitive(month):
     """Convert month name to genitive case"""
-    return re.sub(r"ὕστερος", "ὑστέρου", re.sub(r"ών", "ῶνος", month))
+    # Plain substrings, so str.replace is enough (and faster than re.sub)
+    return month.replace("ών", "ῶνος").replace("ὕστερος", "ὑστέρου")
+
+
+def day_name(day_num, month_length):
+    """Return Greek name of day number in a month of given length"""
+
+    if day_num == month_length:
+        return GK_DAY[30]
+
+    return GK_DAY[day_num]
 
 
 def greek_day_name(day):
     """Return formatted name of the day in Greek"""
+    return day_name(day.day, day.month_length)
 
-    if day.day == day.month_length:
-        return GK_DAY[30]
 
-    return GK_DAY[day.day]
+@functools.lru_cache(None)
+def format_greek_date(day_num, month_length, month):
+    """Format a day of a month in Greek (cached)"""
+    month_gen = to_genitive(greek_month_name(month))
+    day_gk = day_name(day_num, month_length)
+    return f"{day_gk} {month_gen}"
 
 
 def greek_date(day):
     """Return date in Greek"""
-    month_gen = to_genitive(ha.month_name(day.month, name_as=ha.MonthNameOptions.GREEK))
-    day_gk = greek_day_name(day)
-    return f"{day_gk} {month_gen}"
+    return format_greek_date(day.day, day.month_length, day.month)
 
 
 def postulate(day):
@@ -328,26 +474,33 @@ def postulate(day):
 
     post = f"Today ({gregorian_date(day)}) is {day.month_name} {day.day}, {greek_date(day)}, {doy_count(day)}"
 
-    return (
-        (post,)
-        + year_summary(day)
-        + month_summary(day)
-        + festival_summary(day)
-        + festivals(day)
-    )
+    posts = [post]
+
+    # The summaries are only for the first day of the year or month, so skip
+    # them entirely on other days
+    if day.doy == 1:
+        posts.extend(year_summary(day))
+
+    if day.day == 1:
+        posts.extend(month_summary(day))
+        posts.extend(festival_summary(day))
+
+    posts.extend(festivals(day))
 
+    return tuple(posts)
 
-def header(post, show_chars):
+
+def header(post, show_chars, date):
     """Format post header for preview output"""
     if show_chars:
-        return f"{datetime.today().strftime('%Y-%b-%d')} ({len(post)} chars)"
+        return f"{date} ({len(post)} chars)"
 
-    return datetime.today().strftime("%Y-%b-%d")
+    return date
 
 
-def show_post(post, show_char_count):
+def show_post(post, show_char_count, date):
     """Format post for preview output"""
-    return "\n".join((header(post, args.characters), "-" * 30, post, ""))
+    return "\n".join((header(post, show_char_count, date), "-" * 30, post, ""))
 
 
 def escape(s):
@@ -360,32 +513,33 @@ def unescape(s):
     return s.replace("\\n", "\n")
 
 
-def max_count(posts):
-    """Return the highest serial index in list of posts"""
-    if not posts:
-        return 0
-
-    return int(max([p[0] for p in posts]))
-
-
+@functools.lru_cache(maxsize=4096)
 def jdn_from_date(date):
-    """Return JDN from formatted date"""
+    """Return JDN from formatted date (cached, since posts share dates)"""
     return int(
         jd.from_gregorian(*tuple(datetime.strptime(date, "%Y-%b-%d").timetuple())[:3])
         + 0.5
     )
 
 
-def max_date(posts):
-    """Return latest date in list of posts"""
-    if not posts:
-        return 0
+def summarize_posts(posts):
+    """Return the highest serial index and latest date in list of posts"""
+    top_count = 0
+    top_date = 0
+
+    for p in posts:
+        top_count = max(top_count, int(p[0]))
+        top_date = max(top_date, jdn_from_date(p[1]))
 
-    return max([jdn_from_date(p[1]) for p in posts])
+    return (top_count, top_date)
 
 
-def output_existing(writer, args, after=today_jdn()):
+def output_existing(writer, args, date, after=None):
     """Load and output existing rows if requested and necessary"""
+    # Default to today when called, not when this module was imported
+    if after is None:
+        after = today_jdn()
+
     # Load existing post if requested
     try:
         current_posts = get_current_posts(args.file) if args.append else ()
@@ -400,15 +554,17 @@ def output_existing(writer, args, after=today_jdn()):
         raise e
 
     # Ouput existing posts if there are any
-    for post in current_posts:
-        if args.keep_old or jdn_from_date(post[1]) >= after:
-            if not args.csv:
-                print(show_post(unescape(post[3]), args.characters))
+    keep = [p for p in current_posts if args.keep_old or jdn_from_date(p[1]) >= after]
 
-            if args.csv:
-                writer.writerow((int(post[0]), post[1], int(post[2]), post[3]))
+    if not args.csv:
+        for post in keep:
+            print(show_post(unescape(post[3]), args.characters, date))
 
-    return (max_count(current_posts) + 1, max_date(current_posts))
+    if args.csv:
+        writer.writerows([(int(p[0]), p[1], int(p[2]), p[3]) for p in keep])
+
+    (top_count, top_date) = summarize_posts(current_posts)
+    return (top_count + 1, top_date)
 
 
 if __name__ == "__main__":
@@ -470,20 +626,26 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     writer = csv.writer(sys.stdout, delimiter="\t", quoting=csv.QUOTE_NONNUMERIC)
-    (count, append_after) = output_existing(writer, args)
+    # Read the clock once for the whole run
+    today = datetime.today()
+    today_str = today.strftime("%Y-%b-%d")
+
+    (count, append_after) = output_existing(
+        writer, args, today_str, today_jdn(today)
+    )
 
-    for day in get_calendar(args):
+    # Rows are written in batches rather than one writerow() call each
+    rows = []
+
+    for day in get_calendar(args, today):
         if day.jdn > append_after:
             for post in postulate(day):
 
                 if not args.csv:
-                    print(header(post, args.characters))
-                    print("-" * 30)
-                    print(post)
-                    print()
+                    print(show_post(post, args.characters, today_str))
 
                 if args.csv:
-                    writer.writerow(
+                    rows.append(
                         (
                             count,
                             ha.as_gregorian(day.jdn).split()[-1],
@@ -492,4 +654,10 @@ if __name__ == "__main__":
                         )
                     )
 
+                    if len(rows) >= CSV_BATCH:
+                        writer.writerows(rows)
+                        rows.clear()
+
                 count += 1
+
+    writer.writerows(rows)
@@ -1,11 +1,25 @@
+import os
+import pickle
 import pytest
 import hemerologion as hem
 import heniautos as ha
 import argparse
+import base64
 from collections import namedtuple
+import csv
+from datetime import datetime
+import importlib.util
+import json
 
 Day = namedtuple("Day", ("month", "day", "month_length"))
 
+# The post script's file name isn't importable as a module name
+spec = importlib.util.spec_from_file_location(
+    "hemerologion_post", "hemerologion-post.py"
+)
+post = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(post)
+
 
 @pytest.fixture
 def cal_2023():
@@ -34,6 +48,26 @@ def test_get_calendar_by_days():
     assert len(cal) == 10
 
 
+def test_get_calendar_by_days_builds_one_year():
+    options = argparse.Namespace(year=None, days=10)
+    hem.festival_calendar.cache_clear()
+
+    # Before June the new year hasn't started, so only 2024 is needed
+    cal = hem.get_calendar(options, datetime(2025, 3, 1))
+    assert len(cal) == 10
+    assert cal[0].astronomical_year == 2024
+    assert hem.festival_calendar.cache_info().misses == 1
+
+def test_festival_calendar_cached():
+    assert hem.festival_calendar(2024) is hem.festival_calendar(2024)
+    assert hem.festival_calendar(2024) == ha.athenian_festival_calendar(2024)
+
+    assert hem.calendar_months(2024) is hem.calendar_months(2024)
+    assert hem.calendar_months(2024) == ha.by_months(
+        ha.athenian_festival_calendar(2024)
+    )
+
+
 def test_get_single_festival_for_day():
     fests = hem.festivals_by_day(Day(1, 12, 30))
     assert len(fests) == 1
@@ -60,6 +94,40 @@ def test_festival_hene_kai_nea():
     assert not hem.festivals_by_day(Day(4, 29, 30))
 
 
+def test_month_festivals_spans():
+    assert hem.month_festivals(3)[1] == (
+        (13, "13–24: Eleusinian Mysteries (τὰ Μυστήρια)"),
+    )
+
+
+def test_month_festivals_spans_not_contiguous(monkeypatch):
+    # Days of the same festival separated by another festival's row
+    rows = (
+        hem.FestRow(1, 10, "", "", "A", "α", 3),
+        hem.FestRow(1, 11, "", "", "B", "β", 2),
+        hem.FestRow(1, 11, "", "", "A", "α", 3),
+        hem.FestRow(1, 12, "", "", "B", "β", 2),
+        hem.FestRow(1, 12, "", "", "A", "α", 3),
+    )
+    monkeypatch.setitem(hem.FEST_BY_MONTH, 1, rows)
+
+    assert hem.month_festivals(1)[1] == ((10, "10–12: A (α)"), (11, "11–12: B (β)"))
+
+
+def test_summarize_festivals():
+    # Single-day festivals come before spans starting on the same day
+    assert hem.summarize_festivals(11, "Thargēliṓn") == (
+        "Festivals in Thargēliṓn:\n\n"
+        "6: Birthday of Artemis\n"
+        "6–7: Thargelia (Θαργήλια)\n"
+        "7: Birthday of Apollo\n"
+        "19: Bendideia (Βενδίδεια)\n"
+        "25: Plynteria (Πλυντήρια)",
+    )
+
+    assert hem.summarize_festivals(5, "Maimaktēriṓn") == ()
+
+
 def test_backwards_count():
     # Forward count
     assert hem.backwards_count(Day(1, 21, 30)) == 21
@@ -98,6 +166,11 @@ def test_greek_day_name():
     assert hem.greek_day_name(Day(1, 29, 29)) == "ἕνῃ καὶ νέᾳ"
 
 
+def test_to_genitive():
+    assert hem.to_genitive("Ἑκατομβαιών") == "Ἑκατομβαιῶνος"
+    assert hem.to_genitive("Ποσιδειών ὕστερος") == "Ποσιδειῶνος ὑστέρου"
+
+
 def test_summary_of_months(cal_2023):
     months = ha.by_months(cal_2023)
     s = hem.summary_of_months(months).split("\n")
@@ -161,3 +234,123 @@ def test_year_summary(cal_2024):
     assert split_s2[0] == "Months in 2024/2025 (2/2):"
     assert split_s2[2] == "Gamēliṓn: Dec 31–Jan 29"
     assert split_s2[7] == "Skirophoriṓn: May 28–Jun 25"
+
+
+def test_summarize_posts():
+    posts = [
+        [1.0, "2024-Nov-30", 111.0, "a"],
+        [3.0, "2024-Dec-02", 95.0, "c"],
+        [2.0, "2024-Dec-01", 105.0, "b"],
+    ]
+    assert hem.summarize_posts(posts) == (3, hem.jdn_from_date("2024-Dec-02"))
+    assert hem.summarize_posts([]) == (0, 0)
+
+
+def test_parse_field():
+    assert hem.parse_field("12") == 12
+    assert hem.parse_field("-1") == -1
+    assert hem.parse_field("") == ""
+    assert hem.parse_field('"Kronia"') == "Kronia"
+    assert hem.parse_field('"say ""hi"""') == 'say "hi"'
+
+    # Text after the closing quote is kept, as csv does
+    assert hem.parse_field('"Apollo")') == "Apollo)"
+
+
+def test_read_tsv_ignores_stale_cache(tmp_path):
+    fn = tmp_path / "test.tsv"
+    fn.write_text('1\t"one"\n2\t"two"\n')
+
+    # A cache in the old format, without a version
+    with open(f"{fn}.pkl", "wb") as cached:
+        pickle.dump((os.path.getmtime(fn), ((1.0, "one"), (2.0, "two"))), cached)
+
+    rows = hem.read_tsv(str(fn))
+    assert rows == ((1, "one"), (2, "two"))
+    assert type(rows[0][0]) is int
+
+    # Rewritten in the current format
+    with open(f"{fn}.pkl", "rb") as cached:
+        assert pickle.load(cached)[0] == hem.TSV_CACHE_VERSION
+
+
+def test_iter_posts_for_day(tmp_path):
+    fn = tmp_path / "posts.tsv"
+    with open(fn, "w") as f:
+        writer = csv.writer(f, delimiter="\t", quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow((1, "2024-Jul-05", 1, "one"))
+        writer.writerow((2, "2024-Jul-06", 1, "two\\nlines"))
+        writer.writerow((3, "2024-Jul-06", 2, "three"))
+        writer.writerow((4, "2024-Jul-07", 1, "four"))
+        writer.writerow((5, "2024-Jul-06", 1, "out of order"))
+
+    posts = tuple(post.iter_posts_for_day(fn, "2024-Jul-06"))
+
+    # Stops after the first run of matches
+    assert [p[0] for p in posts] == [2, 3]
+    assert posts[0][3] == "two\nlines"
+    assert tuple(post.iter_posts_for_day(fn, "2024-Jul-08")) == ()
+
+
+def test_check_config():
+    cfg = {
+        "BLUESKY": 1,
+        "BLUESKY_ID": "someone.bsky.social",
+        "BLUESKY_PASSWORD": None,
+        "MASTODON": 0,
+        "MASTODON_KEY": None,
+        "MASTODON_SECRET": None,
+        "MASTODON_TOKEN": None,
+    }
+
+    with pytest.raises(post.HemerologionPostError, match="BLUESKY_PASSWORD"):
+        post.check_config(cfg, "BLUESKY")
+
+    # Not enabled, so missing settings don't matter
+    post.check_config(cfg, "MASTODON")
+
+    cfg["BLUESKY_PASSWORD"] = "secret"
+    post.check_config(cfg, "BLUESKY")
+
+
+def test_env_flag(monkeypatch):
+    for value in ("1", "true", "yes"):
+        monkeypatch.setenv("BLUESKY", value)
+        assert post.env_flag("BLUESKY")
+
+    for value in ("", "0"):
+        monkeypatch.setenv("BLUESKY", value)
+        assert not post.env_flag("BLUESKY")
+
+    monkeypatch.delenv("BLUESKY")
+    assert not post.env_flag("BLUESKY")
+
+def test_jwt_expiry():
+    def b64(d):
+        return base64.urlsafe_b64encode(json.dumps(d).encode()).decode().rstrip("=")
+
+    for exp in (1720000000, 1720000001, 1720000012):
+        jwt = ".".join((b64({"alg": "ES256K"}), b64({"exp": exp}), "sig"))
+        assert post.jwt_expiry(jwt) == exp
+
+
+
+def test_bluesky_session_bad_token(monkeypatch):
+    class Resp:
+        def __init__(self, jwt):
+            self.jwt = jwt
+
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return {"accessJwt": self.jwt, "did": "did:plc:test"}
+
+    for jwt in ("not-a-jwt", "a.e30.sig", "a.!!!.sig"):
+        monkeypatch.setattr(post.SESSION, "post", lambda *a, **k: Resp(jwt))
+        post.bluesky_session.cache_clear()
+
+        with pytest.raises(post.HemerologionPostError):
+            post.bluesky_session()
+
+    post.bluesky_session.cache_clear()